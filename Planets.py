@@ -1,6 +1,10 @@
 import pygame
+import numpy as np
+from numba import njit
 import math
 import sys
+from collections import OrderedDict, deque
+import quadtree
 
 # Initialize game and screen
 pygame.init()
@@ -15,13 +19,24 @@ BLACK = (0, 0, 0)
 GRAY = (150, 150, 150)
 HIGHLIGHT = (200, 200, 200) # For button hover
 LABEL_BG = (0, 0, 0, 128)  # Semi-transparent black
+TRAIL_COLOR = (50, 50, 50)
 
 # Simulation parameters
 G = 6.6743e-11 # Gravity Constant
 SCALE = 2.5e-11 # Zoomed out scale
 ZOOM_SCALE = 1e-10 # Zoomed in scale
-DT = 3600 # Time step, 1 hour
+DT = 86400 # Time step, 1 day
 AU = 1.496e11 # Astronomical Unit
+DAY = 86400 # Seconds in a day
+M_SUN = 1.989e30 # Mass of the Sun
+
+# The simulation state is float32 in units of AU, days and Sun masses,
+# in meters r^2 would overflow float32 for the outer planets
+G_SIM = np.float32(G * M_SUN * DAY ** 2 / AU ** 3) # Gravity Constant in AU^3 / (M_sun * day^2)
+R2_MIN = np.float32((1e3 / AU) ** 2) # Closest distance forces are computed for, 1 km, squared
+DT_SIM = np.float32(DT / DAY) # Time step in days
+TRAIL_LENGTH = 200 # Number of points kept in each trail
+TRAIL_REDRAW_INTERVAL = 50 # Frames between full trail redraws, to erase points that dropped off
 zoomed = False # Keeps track of zoom state
 
 # Camera variables
@@ -33,81 +48,196 @@ last_mouse_pos = None
 font = pygame.font.SysFont("arial", 12)
 reset_button = pygame.Rect(10, 10, 100, 30)
 reset_text = font.render("Reset", True, WHITE)
+# Button prerendered with its text, indexed by hover state
+reset_button_surfaces = []
+for button_color in (GRAY, HIGHLIGHT):
+    button_surface = pygame.Surface(reset_button.size)
+    button_surface.fill(button_color)
+    button_surface.blit(reset_text, (10, 5))
+    reset_button_surfaces.append(button_surface)
+# The HUD text only depends on the zoom state, so it is rendered once up front
+zoom_texts = {zoom: font.render(f"Zoom: {'In' if zoom else 'Out'}", True, WHITE) for zoom in (False, True)}
+time_text = font.render(f"Time Step: {DT/3600:.1f} hr", True, WHITE)
+# Area covered by the button and simulation info
+hud_rect = reset_button.unionall([zoom_texts[False].get_rect(topleft=(120, 10)),
+                                  zoom_texts[True].get_rect(topleft=(120, 10)),
+                                  time_text.get_rect(topleft=(120, 30))])
+LABEL_CACHE_SIZE = 64 # Number of rendered hover labels kept
+label_cache = OrderedDict() # (name, distance in AU) -> rendered label, least recently used first
+
+# Trails are drawn incrementally onto this surface, which is also the background of every frame
+trail_surface = pygame.Surface((WIDTH, HEIGHT))
 
 class Body:
-    def __init__(self, x, y, vx, vy, mass, radius, color, name="Body"):
+    __slots__ = ("idx", "radius", "color", "name", "trail", "sprite") # Only cosmetic fields, no per-instance __dict__
+
+    def __init__(self, idx, radius, color, name="Body"):
         """
-                Initialize a body.
-                :param x: initial X position
-                :param y: initial Y position
-                :param vx: initial X velocity (m/s)
-                :param vy: initial Y velocity (m/s)
-                :param mass: Mass of the body (kg)
+                Initialize a body. Its position, velocity and mass live in the
+                module level pos/vel/mass arrays, the body only keeps its index into them.
+                :param idx: Index of the body in the state arrays
                 :param radius: Radius of the body (for visualization)
                 :param color: RGB color of body
                 :param name: Name of the body
                 """
-        self.x, self.y = x, y
-        self.vx, self.vy = vx, vy
-        self.mass, self.radius, self.color = mass, radius, color
+        self.idx = idx
+        self.radius, self.color = radius, color
         self.name = name
-        self.trail = [] # List of coordinated for the trail
-
-    def update_position(self, bodies): # Updates the position of the body
-        fx, fy = 0, 0 # Force components
-        for other in bodies:
-            if other != self:
-                dx = other.x - self.x # X distance to other body
-                dy = other.y - self.y # Y distance to other body
-                r = math.sqrt(dx ** 2 + dy ** 2) # Distance between the bodies
-                if r > 1e3: # Dont use unrealistic forces and avoid zero division
-                    # Gravitational force - F = G * m1 * m2 / r^2
-                    f = G * self.mass * other.mass / (r ** 2)
-                    fx += f * dx / r # Add force components, normalized by distance
-                    fy += f * dy / r
-
-        # Acceleration: a = F/m
-        ax = fx / self.mass
-        ay = fy / self.mass
-        # Update velocity: v = v + a * dt
-        self.vx += ax * DT
-        self.vy += ay * DT
-        # Update pos: x = x + v * dt
-        self.x += self.vx * DT
-        self.y += self.vy * DT
-
-        # Convert pos to screen coordinates
-        current_scale = ZOOM_SCALE if zoomed else SCALE
-        screen_x = int(self.x * current_scale + WIDTH // 2 - camera_x)
-        screen_y = int(self.y * current_scale + HEIGHT // 2 - camera_y)
-        self.trail.append((screen_x, screen_y)) # Add trail
-        if len(self.trail) > 200: # Limit trail to 200 points
-            self.trail.pop(0)
-
-    def draw(self, mouse_pos): # Draw the body and trail and label if mouse is near
-        current_scale = ZOOM_SCALE if zoomed else SCALE
-        # Current screen coordinated
-        screen_x = int(self.x * current_scale + WIDTH // 2 - camera_x)
-        screen_y = int(self.y * current_scale + HEIGHT // 2 - camera_y)
-
-        # Draw trail
-        if len(self.trail) > 1:
-            pygame.draw.lines(screen, (50, 50, 50), False, self.trail, 1)
-
-        # Draw body
-        pygame.draw.circle(screen, self.color, (screen_x, screen_y), max(self.radius, 2)) # min radius 2
-
-        # Draw label only if mouse is near the planet
-        mouse_distance = math.sqrt((mouse_pos[0] - screen_x) ** 2 + (mouse_pos[1] - screen_y) ** 2)
-        if mouse_distance < 30:  # Show label if mouse is within 30 pixels
-            # Calculate distance to sun
-            sun = bodies[0]
-            dist = math.sqrt((self.x - sun.x) ** 2 + (self.y - sun.y) ** 2) / AU
-            # Render label with name and distance
-            label = font.render(f"{self.name}: {dist:.2f} AU", True, WHITE)
-            label_rect = label.get_rect(center=(screen_x, screen_y - self.radius - 15))
-            pygame.draw.rect(screen, LABEL_BG, label_rect, border_radius=5) # Background for label
-            screen.blit(label, label_rect)
+        self.trail = deque(maxlen=TRAIL_LENGTH) # Ring buffer of coordinates for the trail
+        # Prerender the body once, drawing it is then a blit (see sprite_batch)
+        r = max(radius, 2) # min radius 2
+        self.sprite = pygame.Surface((2 * r + 1, 2 * r + 1), pygame.SRCALPHA)
+        pygame.draw.circle(self.sprite, color, (r, r), r)
+
+    # Read-only views of the body's numeric state in the shared arrays, in SI units
+    @property
+    def x(self):
+        return float(pos[self.idx, 0]) * AU
+
+    @property
+    def y(self):
+        return float(pos[self.idx, 1]) * AU
+
+    @property
+    def vx(self):
+        return float(vel[self.idx, 0]) * AU / DAY
+
+    @property
+    def vy(self):
+        return float(vel[self.idx, 1]) * AU / DAY
+
+    @property
+    def mass(self):
+        return float(mass[self.idx]) * M_SUN
+
+    def update_trail(self, screen_x, screen_y): # Adds the current screen position to the trail, returns the changed area
+        changed = None
+        if self.trail: # Only the newest segment needs drawing, the rest is already on the trail surface
+            changed = pygame.draw.line(trail_surface, TRAIL_COLOR, self.trail[-1], (screen_x, screen_y))
+        self.trail.append((screen_x, screen_y)) # Add trail, the oldest point drops off once full
+        return changed
+
+    def draw_label(self, screen_x, screen_y): # Draw the label with name and distance, returns the drawn area
+        # Calculate distance to sun
+        x, y = pos[self.idx]
+        sun_x, sun_y = pos[0]
+        dist = math.hypot(x - sun_x, y - sun_y)
+        # Render label with name and distance
+        label = render_label(self.name, dist)
+        label_rect = label.get_rect(center=(screen_x, screen_y - self.radius - 15))
+        pygame.draw.rect(screen, LABEL_BG, label_rect, border_radius=5) # Background for label
+        screen.blit(label, label_rect)
+        return label_rect
+
+@njit(cache=True, fastmath=True, inline="always")
+def _add_pair(pos, gm, acc, i, j):
+    """Add the gravitational accelerations between bodies i and j to acc, gm holds G * mass of every body"""
+    dx = pos[j, 0] - pos[i, 0] # X distance from body i to body j
+    dy = pos[j, 1] - pos[i, 1] # Y distance from body i to body j
+    r2 = dx * dx + dy * dy # Squared distance between the bodies
+    if r2 > R2_MIN: # Dont use unrealistic forces and avoid zero division
+        # Acceleration: a = G * m * d / r^3, with 1/r^3 from one reciprocal sqrt
+        inv_r = np.float32(1.0) / math.sqrt(r2)
+        s = inv_r * inv_r * inv_r # Mutual factor, without G and the masses
+        sx, sy = s * dx, s * dy
+        # Newton's third law gives the opposite force on the other body
+        acc[i, 0] += gm[j] * sx
+        acc[i, 1] += gm[j] * sy
+        acc[j, 0] -= gm[i] * sx
+        acc[j, 1] -= gm[i] * sy
+
+@njit(cache=True, fastmath=True)
+def _accelerations(pos, gm):
+    """
+    Gravitational acceleration of every body by direct summation over all pairs.
+    :param pos: (N, 2) contiguous float32 array of positions (AU)
+    :param gm: (N,) float32 array of G * mass (AU^3/day^2)
+    :return: (N, 2) float32 array of accelerations (AU/day^2)
+    """
+    n = pos.shape[0]
+    acc = np.zeros_like(pos)
+    for i in range(n): # Each pair is visited once
+        for j in range(i + 1, n):
+            _add_pair(pos, gm, acc, i, j)
+    return acc
+
+def _specialize_accelerations(n):
+    """
+    Compile _accelerations for a fixed number of bodies. With n a compile time
+    constant LLVM can fully unroll the pair loops for small systems.
+    """
+    @njit(fastmath=True)
+    def accelerations_n(pos, gm):
+        acc = np.zeros_like(pos)
+        for i in range(n):
+            for j in range(i + 1, n):
+                _add_pair(pos, gm, acc, i, j)
+        return acc
+    return accelerations_n
+
+@njit(cache=True, fastmath=True)
+def _kick(vel, acc, dt):
+    """Update velocity in place: v = v + a * dt"""
+    for i in range(vel.shape[0]):
+        vel[i, 0] += acc[i, 0] * dt
+        vel[i, 1] += acc[i, 1] * dt
+
+@njit(cache=True, fastmath=True)
+def _drift(pos, vel, dt):
+    """Update pos in place: x = x + v * dt"""
+    for i in range(pos.shape[0]):
+        pos[i, 0] += vel[i, 0] * dt
+        pos[i, 1] += vel[i, 1] * dt
+
+def accelerations(pos, gm):
+    """Accelerations of all bodies, from the Barnes-Hut tree for large N and direct summation otherwise"""
+    if USE_BARNES_HUT:
+        return quadtree.accelerations(pos, gm, R2_MIN)
+    return _direct_accelerations(pos, gm)
+
+def render_label(name, dist):
+    """Render a hover label, reusing the surface while the shown distance doesnt change"""
+    key = (name, round(dist, 2))
+    label = label_cache.get(key)
+    if label is None:
+        label = font.render(f"{name}: {dist:.2f} AU", True, WHITE)
+        label_cache[key] = label
+        if len(label_cache) > LABEL_CACHE_SIZE:
+            label_cache.popitem(last=False) # Drop the least recently used label
+    else:
+        label_cache.move_to_end(key)
+    return label
+
+def sprite_batch(bodies):
+    """Sprites of all bodies and their offsets from the body centers, to draw them with one blits call"""
+    sprites = [body.sprite for body in bodies]
+    offsets = np.array([max(body.radius, 2) for body in bodies], dtype=np.int32)[:, None]
+    return sprites, offsets
+
+def redraw_trails(bodies):
+    """Redraw the trail surface from scratch with the points currently kept in each trail"""
+    trail_surface.fill(BLACK)
+    for body in bodies:
+        if len(body.trail) > 1:
+            pygame.draw.lines(trail_surface, TRAIL_COLOR, False, body.trail, 1)
+
+def step(pos, vel, acc, gm, dt):
+    """
+    Advance all bodies by one kick-drift-kick leapfrog step, in place.
+    Leapfrog is symplectic, so the orbits dont drift in energy like with Euler
+    and a much larger time step can be used. Forces are still computed once per step.
+    :param pos: (N, 2) float32 array of positions (AU)
+    :param vel: (N, 2) float32 array of velocities (AU/day)
+    :param acc: (N, 2) float32 array of accelerations at the current positions (AU/day^2)
+    :param gm: (N,) float32 array of G * mass (AU^3/day^2)
+    :param dt: Time step (days)
+    :return: Accelerations at the new positions, to be passed to the next step
+    """
+    _kick(vel, acc, 0.5 * dt) # Half kick with the old forces
+    _drift(pos, vel, dt)
+    acc = accelerations(pos, gm)
+    _kick(vel, acc, 0.5 * dt) # Half kick with the new forces
+    return acc
 
 # Data for all the planets!
 planets_data = [
@@ -123,32 +253,66 @@ planets_data = [
     (5.906e12, 0.2488, 1.309e22, 2, (150, 100, 50), "Pluto"),
 ]
 
-def get_initial_conditions(a, e, mass, radius, color, name, central_mass=1.989e30):
+# Barnes-Hut only pays off once the tree overhead is smaller than the N^2 pair loop
+USE_BARNES_HUT = len(planets_data) > 64
+# Small systems get a direct summation kernel specialized for their number of bodies
+N_UNROLL_MAX = 16
+if len(planets_data) <= N_UNROLL_MAX:
+    _direct_accelerations = _specialize_accelerations(len(planets_data))
+else:
+    _direct_accelerations = _accelerations
+
+def get_initial_conditions(a, e, mass, radius, color, name, central_mass=M_SUN):
     """Calculate initial position and velocity for a body at perihelion"""
+    if a == 0:
+        return (0, 0), (0, 0)
     r = a * (1 - e)
     x = r # Place along x-axis
     y = 0
-    if a == 0:
-        return Body(0, 0, 0, 0, mass, radius, color, name)
     # Velocity at perihelion: v = sqrt(G * M * (1 + e) / (a * (1 - e)))
     v = math.sqrt(G * central_mass * (1 + e) / (a * (1 - e)))
     vx = 0
     vy = v # Tangential velocity along y-axis
-    return Body(x, y, vx, vy, mass, radius, color, name)
+    return (x, y), (vx, vy)
+
+def build_bodies():
+    """Build the state arrays and the bodies that index into them"""
+    n = len(planets_data)
+    pos = np.zeros((n, 2), dtype=np.float32) # Positions (AU)
+    vel = np.zeros((n, 2), dtype=np.float32) # Velocities (AU/day)
+    mass = np.array([data[2] / M_SUN for data in planets_data], dtype=np.float32) # Masses (M_sun)
+    bodies = []
+    for i, data in enumerate(planets_data):
+        (x, y), (vx, vy) = get_initial_conditions(*data)
+        pos[i] = x / AU, y / AU
+        vel[i] = vx * DAY / AU, vy * DAY / AU
+        _, _, _, radius, color, name = data
+        bodies.append(Body(i, radius, color, name))
+    return bodies, pos, vel, mass
 
 def reset_simulation():
     """Reset simulation to initial conditions"""
-    global bodies, camera_x, camera_y, zoomed
-    bodies = [get_initial_conditions(*data) for data in planets_data]
+    global bodies, pos, vel, mass, gm, acc, sprites, sprite_offsets, camera_x, camera_y, zoomed
+    bodies, pos, vel, mass = build_bodies()
+    sprites, sprite_offsets = sprite_batch(bodies)
+    gm = G_SIM * mass # G * mass is all the force kernels need, computed once instead of per pair
+    acc = accelerations(pos, gm)
     camera_x, camera_y = 0, 0
     zoomed = False
 
 # Initialize bodies
-bodies = [get_initial_conditions(*data) for data in planets_data]
+bodies, pos, vel, mass = build_bodies()
+sprites, sprite_offsets = sprite_batch(bodies)
+gm = G_SIM * mass
+acc = accelerations(pos, gm) # Also warms up the JIT so the first frame doesnt stall on compilation
+step(pos.copy(), vel.copy(), acc, gm, DT_SIM)
 
 # Main game loop!
 running = True
-trail_reset = False # Flag to reset trails on camera or zoom change
+trail_reset = True # Flag to reset trails on camera or zoom change, also forces a full redraw of the first frame
+frame_count = 0
+prev_drawn = [] # Screen areas of the bodies and labels drawn in the last frame
+prev_reset_hovered = False
 while running:
     mouse_pos = pygame.mouse.get_pos() # Current mouse position
     reset_hovered = reset_button.collidepoint(mouse_pos) # If current mouse pos hovers over reset button
@@ -191,26 +355,65 @@ while running:
             last_mouse_pos = current_pos
             trail_reset = True
 
-    screen.fill(BLACK) # Clear screen
+    acc = step(pos, vel, acc, gm, DT_SIM) # Update position and velocity of all bodies
 
-    # Draw reset button
-    pygame.draw.rect(screen, HIGHLIGHT if reset_hovered else GRAY, reset_button)
-    screen.blit(reset_text, (reset_button.x + 10, reset_button.y + 5))
+    # Convert all positions to screen coordinates at once
+    scale = ZOOM_SCALE if zoomed else SCALE
+    ox = WIDTH // 2 - camera_x
+    oy = HEIGHT // 2 - camera_y
+    screen_pos = (pos * (scale * AU) + (ox, oy)).astype(np.int32)
+    screen_xy = screen_pos.tolist()
+    # Show a label if the mouse is within 30 pixels of a body, tested for all bodies at once
+    mouse_d = screen_pos - np.array(mouse_pos)
+    hovered = np.flatnonzero((mouse_d * mouse_d).sum(axis=1) < 900)
 
-    # Draw simulation info
-    zoom_text = font.render(f"Zoom: {'In' if zoomed else 'Out'}", True, WHITE)
-    time_text = font.render(f"Time Step: {DT/3600:.1f} hr", True, WHITE)
-    screen.blit(zoom_text, (120, 10))
-    screen.blit(time_text, (120, 30))
+    full_redraw = trail_reset # Camera or zoom changes move everything, so the whole screen is redrawn
+    if trail_reset:
+        for body in bodies:
+            body.trail.clear() # Clear trail on bodies
+        trail_surface.fill(BLACK)
+    dirty = prev_drawn # Areas drawn last frame are erased this frame
+    for body, (screen_x, screen_y) in zip(bodies, screen_xy):
+        changed = body.update_trail(screen_x, screen_y)
+        if changed:
+            dirty.append(changed)
+    frame_count += 1
+    if frame_count % TRAIL_REDRAW_INTERVAL == 0:
+        redraw_trails(bodies)
+        full_redraw = True
+    if reset_hovered != prev_reset_hovered:
+        dirty.append(hud_rect)
+        prev_reset_hovered = reset_hovered
+    # The HUD is only redrawn when something erased it, blending its text over itself would smear it
+    draw_hud = full_redraw or hud_rect.collidelist(dirty) != -1
+    if draw_hud:
+        dirty.append(hud_rect)
 
-    for body in bodies:
-        body.update_position(bodies) # Update position and velocity
-        if trail_reset:
-            body.trail = [] # Clear trail on bodies
-        body.draw(mouse_pos)
+    # Clear screen, with the trails as background
+    if full_redraw:
+        screen.blit(trail_surface, (0, 0))
+    else:
+        for rect in dirty:
+            screen.blit(trail_surface, rect, rect)
+
+    if draw_hud:
+        # Draw reset button
+        screen.blit(reset_button_surfaces[reset_hovered], reset_button)
+
+        # Draw simulation info
+        screen.blit(zoom_texts[zoomed], (120, 10))
+        screen.blit(time_text, (120, 30))
+
+    # Draw all bodies in one batched blit, then the labels of the hovered ones
+    prev_drawn = screen.blits(zip(sprites, (screen_pos - sprite_offsets).tolist()))
+    for i in hovered:
+        prev_drawn.append(bodies[i].draw_label(*screen_xy[i]))
 
     trail_reset = False
-    pygame.display.flip()
+    if full_redraw:
+        pygame.display.flip()
+    else:
+        pygame.display.update(dirty + prev_drawn) # Only push the changed areas to the display
     clock.tick(60)
 
 pygame.quit()
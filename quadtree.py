@@ -0,0 +1,146 @@
+import math
+import numpy as np
+from numba import njit
+
+# Barnes-Hut quadtree for O(N log N) gravity.
+# The tree is rebuilt every time step and stored flattened in arrays (one entry per node),
+# so that building and walking it can both be compiled with Numba.
+
+THETA = 0.5 # Opening angle, a node is treated as one particle when width / distance < THETA
+MAX_DEPTH = 48 # Bodies closer than root_width / 2^MAX_DEPTH share a leaf
+
+@njit(cache=True)
+def _build(pos, mass, capacity):
+    """
+    Build the quadtree for the given bodies.
+    :param pos: (N, 2) array of positions
+    :param mass: (N,) array of masses
+    :param capacity: Number of nodes to allocate
+    :return: Node arrays (cx, cy, width, node_mass, com, child, body), the leaf holding each body
+             and the node count, the node count is -1 if capacity was too small
+    """
+    n = pos.shape[0]
+    cx = np.empty(capacity, pos.dtype) # Center of the node square
+    cy = np.empty(capacity, pos.dtype)
+    width = np.empty(capacity, pos.dtype) # Side length of the node square
+    node_mass = np.zeros(capacity, mass.dtype) # Total mass of the bodies in the node
+    com = np.zeros((capacity, 2), pos.dtype) # Center of mass of the bodies in the node
+    child = np.full((capacity, 4), -1, dtype=np.int32) # Child nodes, -1 for leaves
+    body = np.full(capacity, -1, dtype=np.int32) # Body in a leaf, -1 for empty leaves
+    leaf = np.empty(n, dtype=np.int32) # Leaf each body ended up in
+
+    # Root square covers all bodies
+    min_x, max_x = pos[:, 0].min(), pos[:, 0].max()
+    min_y, max_y = pos[:, 1].min(), pos[:, 1].max()
+    cx[0] = 0.5 * (min_x + max_x)
+    cy[0] = 0.5 * (min_y + max_y)
+    extent = max(max_x - min_x, max_y - min_y)
+    width[0] = extent * 1.0001 if extent > 0 else 1.0
+    count = 1
+
+    for b in range(n):
+        node = 0
+        depth = 0
+        while True:
+            # Every node on the way down contains b, add it to the mass and (unnormalized) center of mass
+            node_mass[node] += mass[b]
+            com[node, 0] += mass[b] * pos[b, 0]
+            com[node, 1] += mass[b] * pos[b, 1]
+            if child[node, 0] < 0:
+                if body[node] < 0: # Empty leaf, store the body here
+                    body[node] = b
+                    leaf[b] = node
+                    break
+                if depth >= MAX_DEPTH: # Leaf too small to split, the bodies are merged
+                    leaf[b] = node
+                    break
+                # Occupied leaf, split it into 4 children and move its body down
+                if count + 4 > capacity:
+                    return cx, cy, width, node_mass, com, child, body, leaf, -1
+                half = 0.5 * width[node]
+                for q in range(4):
+                    c = count + q
+                    cx[c] = cx[node] + (0.5 * half if q & 1 else -0.5 * half)
+                    cy[c] = cy[node] + (0.5 * half if q & 2 else -0.5 * half)
+                    width[c] = half
+                if cx[count] == cx[count + 1] or cy[count] == cy[count + 2]:
+                    # The children cant be told apart at this float precision, merge the bodies instead
+                    leaf[b] = node
+                    break
+                for q in range(4):
+                    child[node, q] = count + q
+                count += 4
+                k = body[node]
+                body[node] = -1
+                q = (1 if pos[k, 0] >= cx[node] else 0) + (2 if pos[k, 1] >= cy[node] else 0)
+                c = child[node, q]
+                body[c] = k
+                leaf[k] = c
+                node_mass[c] = mass[k]
+                com[c, 0] = mass[k] * pos[k, 0]
+                com[c, 1] = mass[k] * pos[k, 1]
+            # Descend into the quadrant containing b
+            q = (1 if pos[b, 0] >= cx[node] else 0) + (2 if pos[b, 1] >= cy[node] else 0)
+            node = child[node, q]
+            depth += 1
+
+    # Normalize the centers of mass
+    for node in range(count):
+        if node_mass[node] > 0:
+            com[node, 0] /= node_mass[node]
+            com[node, 1] /= node_mass[node]
+    return cx, cy, width, node_mass, com, child, body, leaf, count
+
+@njit(cache=True, fastmath=True)
+def _walk(pos, min_r2, theta, cx, cy, width, node_mass, com, child, leaf):
+    """Accelerations on every body from a built tree"""
+    n = pos.shape[0]
+    acc = np.zeros_like(pos)
+    theta2 = theta * theta
+    stack = np.empty(3 * MAX_DEPTH + 4, dtype=np.int32)
+    for i in range(n):
+        ax, ay = 0.0, 0.0
+        stack[0] = 0
+        sp = 1
+        while sp > 0:
+            sp -= 1
+            node = stack[sp]
+            if node_mass[node] == 0 or node == leaf[i]: # Skip empty nodes and the body's own leaf
+                continue
+            dx = com[node, 0] - pos[i, 0]
+            dy = com[node, 1] - pos[i, 1]
+            r2 = dx * dx + dy * dy
+            half = 0.5 * width[node]
+            inside = abs(pos[i, 0] - cx[node]) <= half and abs(pos[i, 1] - cy[node]) <= half
+            if child[node, 0] >= 0 and (inside or width[node] * width[node] >= theta2 * r2):
+                # Too close to use the pseudo-particle, open the node. Nodes containing
+                # the body are always opened, its center of mass can round to right next to the body
+                for q in range(4):
+                    stack[sp] = child[node, q]
+                    sp += 1
+            elif r2 > min_r2: # Dont use unrealistic forces and avoid zero division
+                inv_r = 1.0 / math.sqrt(r2)
+                a = node_mass[node] * inv_r * inv_r * inv_r
+                ax += a * dx
+                ay += a * dy
+        acc[i, 0] = ax
+        acc[i, 1] = ay
+    return acc
+
+def accelerations(pos, gm, min_r2, theta=THETA):
+    """
+    Approximate gravitational accelerations with the Barnes-Hut algorithm.
+    Works in whatever units and float type pos and gm are given in.
+    :param pos: (N, 2) array of positions
+    :param gm: (N,) array of G * mass, the tree aggregates these like masses
+    :param min_r2: Squared distance below which forces are ignored
+    :param theta: Opening angle
+    :return: (N, 2) array of accelerations, same type as pos
+    """
+    capacity = 8 * len(pos) + 1
+    while True:
+        cx, cy, width, node_mass, com, child, body, leaf, count = _build(pos, gm, capacity)
+        if count >= 0:
+            break
+        capacity *= 2 # Bodies were clustered, retry with more nodes
+    return _walk(pos, min_r2, theta, cx, cy, width, node_mass, com, child, leaf)